@@ -43,29 +43,29 @@ class TestMatlab(unittest.TestCase):
 
         #TODO test doesnt work, but I have no time to debug 
         repetitions = 15  # no k set
-        with patch('numpy.random.permutation', lambda x: np.array(ml.randperm(x)).squeeze()-1): 
-            for i in tqdm(list(range(1, repetitions)), desc='Running tests 1/2'):
-                X = np.random.randint(0, 100, 4)
-                X_ml = matlab.int64(X.tolist())
-                
-                # monkey-patch permutation function to MATLAB.randperm to get same random results
-                permutation = lambda x: np.array(ml.randperm(x), dtype=int).squeeze() - 1
-                ml.rng(i)
-                nPerms_py, pInds_py, Perms_py = uperms(X)
-                ml.rng(i)
-                nPerms_ml, pInds_ml, Perms_ml = ml.uperms(X_ml, nargout=3)
+        # unique_permutations draws its permutations inside a numba kernel,
+        # so they differ from MATLAB. Results are only comparable because
+        # all permutations are enumerated (no k set) and rows are sorted
+        for i in tqdm(list(range(1, repetitions)), desc='Running tests 1/2'):
+            X = np.random.randint(0, 100, 4)
+            X_ml = matlab.int64(X.tolist())
+            
+            ml.rng(i)
+            nPerms_py, pInds_py, Perms_py = uperms(X)
+            ml.rng(i)
+            nPerms_ml, pInds_ml, Perms_ml = ml.uperms(X_ml, nargout=3)
     
-                pInds_ml = np.array(pInds_ml) - 1
-                pInds_ml.sort(0)
-                pInds_py.sort(0)
+            pInds_ml = np.array(pInds_ml) - 1
+            pInds_ml.sort(0)
+            pInds_py.sort(0)
     
-                Perms_ml = np.array(Perms_ml)
-                Perms_ml.sort(0)
-                Perms_py.sort(0)
+            Perms_ml = np.array(Perms_ml)
+            Perms_ml.sort(0)
+            Perms_py.sort(0)
     
-                np.testing.assert_almost_equal(nPerms_py, nPerms_ml)
-                np.testing.assert_almost_equal(pInds_py, pInds_ml)
-                np.testing.assert_almost_equal(Perms_py, Perms_ml)
+            np.testing.assert_almost_equal(nPerms_py, nPerms_ml)
+            np.testing.assert_almost_equal(pInds_py, pInds_ml)
+            np.testing.assert_almost_equal(Perms_py, Perms_ml)
 
         repetitions = 15
         for i in tqdm(list(range(repetitions)), desc='Running tests 2/2'):
@@ -74,8 +74,7 @@ class TestMatlab(unittest.TestCase):
             X_ml = matlab.int64(X.tolist())
             k = np.random.randint(1, len(X))
             
-            # monkey-patch to get same random results
-            permutation = lambda x: np.array(ml.randperm(x), dtype=int).squeeze() - 1  
+            # no k set, so all permutations are compared after sorting the rows
             ml.rng(i)
             nPerms_py, pInds_py, Perms_py = uperms(X, None)
             ml.rng(i)
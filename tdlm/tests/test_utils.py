@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+test util functions that can be checked without the MATLAB engine
+"""
+import math
+import unittest
+import numpy as np
+
+from tdlm.utils import hash_array, insert_events, seq2tf, seq2TF_2step
+from tdlm.utils import char2num, num2char
+from tdlm.utils import unique_permutations
+from tdlm.utils import _fenwick_build, _fenwick_find, _sample_onsets
+
+
+class TestUniquePermutations(unittest.TestCase):
+
+    def test_unique_rows(self):
+        for X in [np.arange(6), [1, 1, 2, 2, 2, 3], np.eye(4),
+                  np.kron(np.eye(3), np.ones([2, 1]))]:
+            X = np.array(X)
+            # number of unique permutations is the multinomial coefficient
+            _, counts = np.unique(X, axis=0, return_counts=True)
+            expected = math.factorial(len(X))
+            for c in counts:
+                expected //= math.factorial(c)
+
+            nPerms, pInds, Perms = unique_permutations(X)
+            self.assertEqual(nPerms, expected)
+            self.assertEqual(len(pInds), expected)
+            np.testing.assert_array_equal(pInds[0], np.arange(len(X)))
+            # Perms is [k n] for vectors and [n m k] for matrices
+            rows = Perms if X.ndim == 1 else Perms.transpose(2, 0, 1)
+            rows = rows.reshape(nPerms, -1)
+            self.assertEqual(len(np.unique(rows, axis=0)), expected)
+
+    def test_subset_and_seed(self):
+        np.random.seed(0)
+        nPerms, pInds1, _ = unique_permutations(np.arange(20), 500)
+        np.random.seed(0)
+        _, pInds2, _ = unique_permutations(np.arange(20), 500)
+        self.assertEqual(nPerms, math.factorial(20))
+        self.assertEqual(len(np.unique(pInds1, axis=0)), 500)
+        np.testing.assert_array_equal(pInds1, pInds2)
+
+
+class TestSampleOnsets(unittest.TestCase):
+
+    def test_fenwick_find(self):
+        rng = np.random.default_rng(0)
+        p = rng.random(1000)
+        p[100:200] = 0
+        p[-50:] = 0
+        tree = _fenwick_build(p)
+        cdf = np.cumsum(p)
+        for r in rng.random(2000) * cdf[-1]:
+            self.assertEqual(_fenwick_find(tree, r),
+                             np.searchsorted(cdf, r, side='right'))
+
+    def test_sample_onsets(self):
+        rng = np.random.default_rng(0)
+        span = 20
+        for _ in range(20):
+            p = rng.random(2000) ** 2
+            p[:30] = 0
+            p_orig = p.copy()
+            onsets = _sample_onsets(p, rng.random(40), span)
+            self.assertEqual(len(onsets), 40)
+            # never a zero weight onset and never overlapping events
+            self.assertTrue((p_orig[onsets] > 0).all())
+            self.assertTrue((np.diff(np.sort(onsets)) >= span).all())
+
+    def test_sample_onsets_exhausted(self):
+        rng = np.random.default_rng(0)
+        onsets = _sample_onsets(np.ones(100), rng.random(20), 10)
+        self.assertLess(len(onsets), 20)
+        with self.assertRaises(ValueError):
+            insert_events(np.zeros([300, 4]), np.ones([6, 4]),
+                          np.repeat(np.arange(3), 2), [0, 1, 2], n_events=100)
+
+
+class TestInsertEvents(unittest.TestCase):
+
+    def _check_inside(self, data, insert_data, **kwargs):
+        """insert patterns of ones and check that all of them end up
+        completely inside the event windows of data"""
+        labels = np.repeat(np.arange(3), len(insert_data)//3)
+        data_sim, df = insert_events(data, insert_data, labels, [0, 1, 2],
+                                     return_onsets=True, **kwargs)
+        t = 1 if insert_data.ndim == 2 else insert_data.shape[-1]
+        starts = df.pos.values - t//2
+        self.assertTrue((starts >= 0).all())
+        self.assertTrue((starts + t <= len(data)).all())
+
+        inside = np.zeros(len(data), dtype=bool)
+        for start in starts:
+            inside[start:start+t] = True
+        diff = data_sim - data
+        np.testing.assert_array_equal(diff[~inside], 0)
+        self.assertAlmostEqual(diff.sum(), len(df) * t * data.shape[1])
+
+        # windows of the event trains, including all jittered steps,
+        # must not overlap with each other
+        trains = df.groupby('idx').pos.agg(['min', 'max']).sort_values('min')
+        train_starts = trains['min'].values - t//2
+        train_ends = trains['max'].values - t//2 + t
+        self.assertTrue((train_starts[1:] >= train_ends[:-1]).all())
+
+    def test_events_inside_data(self):
+        """events near the borders of data must not be wrapped or dropped"""
+        for seed in range(50):
+            rng = np.random.default_rng(seed)
+            data = rng.standard_normal([300, 4])
+            self._check_inside(data, np.ones([6, 4]), n_events=3, jitter=10,
+                               distribution='increasing')
+            self._check_inside(data, np.ones([6, 4, 31]), n_events=3,
+                               distribution='decreasing')
+            self._check_inside(data, np.ones([6, 4, 30]), n_events=3,
+                               jitter=3, distribution='increasing')
+
+    def test_jittered_events_not_overlapping(self):
+        for seed in range(50):
+            data = np.random.default_rng(seed).standard_normal([600, 4])
+            self._check_inside(data, np.ones([6, 4, 3]), n_events=10,
+                               lag=5, jitter=4)
+
+    def test_reproducible(self):
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal([2000, 4])
+        insert_data = rng.standard_normal([6, 4, 5])
+        labels = np.repeat(np.arange(3), 2)
+        out1, df1 = insert_events(data, insert_data, labels, [0, 1, 2], 10,
+                                  jitter=2, return_onsets=True)
+        out2, df2 = insert_events(data, insert_data, labels, [0, 1, 2], 10,
+                                  jitter=2, return_onsets=True)
+        np.testing.assert_array_equal(out1, out2)
+        self.assertTrue(df1.equals(df2))
+        # input data is not changed
+        self.assertFalse(np.array_equal(out1, data))
+
+    def test_dtype_mismatch(self):
+        # float patterns must not be silently truncated when added to int data
+        with self.assertRaises(TypeError):
+            insert_events(np.zeros([1000, 3], dtype=np.int64),
+                          np.full([6, 3, 5], 0.7), np.repeat(np.arange(3), 2),
+                          [0, 1, 2], n_events=2)
+        # int patterns can be added to float data
+        data_sim = insert_events(np.zeros([1000, 3]), np.ones([6, 3, 5], dtype=int),
+                                 np.repeat(np.arange(3), 2), [0, 1, 2], n_events=2)
+        self.assertEqual(data_sim.sum(), 2 * 3 * 3 * 5)
+
+    def test_too_short_data(self):
+        data = np.zeros([40, 4])
+        with self.assertRaises(ValueError):
+            insert_events(data, np.ones([6, 4, 31]), np.repeat(np.arange(3), 2),
+                          [0, 1, 2], n_events=1)
+
+
+class TestHashArray(unittest.TestCase):
+
+    def test_hash_array(self):
+        arr = np.random.default_rng(0).standard_normal([20, 30])
+        self.assertEqual(hash_array(arr), hash_array(arr.copy()))
+        self.assertEqual(hash_array(arr), hash_array(np.asfortranarray(arr)))
+        self.assertEqual(hash_array(arr), hash_array(memoryview(arr)))
+        self.assertEqual(len(hash_array(arr, truncate=5)), 5)
+        # reshaped arrays and different dtypes must not collide
+        self.assertNotEqual(hash_array(arr), hash_array(arr.reshape(30, 20)))
+        self.assertNotEqual(hash_array(arr), hash_array(arr.view(np.int64)))
+        self.assertNotEqual(hash_array(arr), hash_array(arr, dtype=np.float32))
+
+    def test_hash_array_datetime(self):
+        for dtype in ['datetime64[s]', 'timedelta64[s]']:
+            arr = np.arange(10).astype(dtype)
+            self.assertEqual(hash_array(arr), hash_array(arr.copy()))
+            self.assertNotEqual(hash_array(arr), hash_array(arr[::-1]))
+
+
+class TestSeq2TF(unittest.TestCase):
+
+    def test_char2num_num2char(self):
+        np.testing.assert_array_equal(char2num('ABc'), [0, 1, 2])
+        np.testing.assert_array_equal(char2num(['A', 'D']), [0, 3])
+        self.assertEqual(num2char(3), 'D')
+        np.testing.assert_array_equal(num2char([[0, 1], [2, 25]]),
+                                      [['A', 'B'], ['C', 'Z']])
+        with self.assertRaises(AssertionError):
+            char2num('AB\u00e9')
+        with self.assertRaises(AssertionError):
+            num2char([0, 200])
+        with self.assertRaises(AssertionError):
+            num2char([-1])
+
+    def test_seq2tf(self):
+        TF = seq2tf('ABCA', n_states=4)
+        expected = np.zeros([4, 4])
+        expected[[0, 1, 2], [1, 2, 0]] = 1
+        np.testing.assert_array_equal(TF, expected)
+
+    def test_states_out_of_bounds(self):
+        with self.assertRaises(IndexError):
+            seq2tf('ABE', n_states=3)
+        with self.assertRaises(IndexError):
+            seq2TF_2step('ABEAB', n_states=3)
+
+    def test_seq2TF_2step_array(self):
+        df = seq2TF_2step('ABCBDA', n_states=5)
+        TF2, index = seq2TF_2step('ABCBDA', n_states=5, as_dataframe=False)
+        self.assertEqual(index, ['AB', 'BC', 'BD', 'CB'])
+        self.assertEqual(index, df.index.tolist())
+        np.testing.assert_array_equal(TF2, df.values)
+        np.testing.assert_array_equal(TF2.argmax(1), [2, 1, 0, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
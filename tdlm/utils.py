@@ -10,19 +10,23 @@ import hashlib
 import math
 import numpy as np
 import pandas as pd
+from numba import njit, types
+from numba.typed import Dict
 
-def hash_array(arr, dtype=np.int64, truncate=8):
+def hash_array(arr, dtype=None, truncate=8):
     """
     create a persistent hash for a numpy array based on the byte representation
     only the last `truncate` (default=8) characters are returned for simplicity
 
     Parameters
     ----------
-    arr : np.ndarray
-        DESCRIPTION.
+    arr : np.ndarray | memoryview
+        array or buffer that should be hashed.
     dtype : type, optional
-        which data type to use. smaller type will be faster.
-        The default is np.int64.
+        which data type to cast to before hashing. If None, the raw bytes of
+        the array are hashed without any conversion. The default is None.
+    truncate : int, optional
+        number of hex characters of the hash to return. The default is 8.
 
     Returns
     -------
@@ -30,9 +34,81 @@ def hash_array(arr, dtype=np.int64, truncate=8):
         unique hash for that array.
 
     """
-    arr = arr.astype(dtype)
-    sha1_hash = hashlib.sha1(arr.flatten("C")).hexdigest()
-    return sha1_hash[:truncate]
+    arr = np.asarray(arr)
+    if dtype is not None and arr.dtype != dtype:
+        arr = arr.astype(dtype)
+    arr = np.ascontiguousarray(arr)
+    # non-cryptographic use, blake2b is much faster than sha1 in software
+    digest_size = min(64, max(1, (truncate + 1) // 2))
+    blake_hash = hashlib.blake2b(digest_size=digest_size)
+    # include shape and dtype to prevent collisions of reshaped arrays
+    blake_hash.update(f'{arr.shape}{arr.dtype.str}'.encode())
+    # hash the contiguous buffer via a uint8 view, this never copies the data.
+    # unlike memoryview, this also works for dtypes such as datetime64
+    blake_hash.update(arr.reshape(-1).view(np.uint8))
+    return blake_hash.hexdigest()[:truncate]
+
+
+@njit(cache=True)
+def _hash_perm(perm):
+    """polynomial rolling hash of a permutation row, wraps around in int64"""
+    h = np.int64(17)
+    for i in range(len(perm)):
+        h = h * np.int64(1000003) + np.int64(perm[i])
+    return h
+
+
+@njit(cache=True)
+def _rows_equal(a, b):
+    """element-wise comparison that stops at the first difference"""
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            return False
+    return True
+
+
+@njit(cache=True)
+def _fill_unique_perms(x, k, n, pInds, perms_matrix, seed):
+    """
+    fill rows 1..k-1 of pInds and perms_matrix with unique random permutations
+    of x. Row 0 must already contain the identity permutation.
+
+    Candidates are drawn via Fisher-Yates shuffle and looked up by their
+    hash, rows are only compared element-wise with accepted rows that have
+    the same hash (chained via next_same).
+    """
+    np.random.seed(seed)
+    pInd = np.arange(n)
+    perm = np.empty(n, dtype=perms_matrix.dtype)
+    # maps hash to the last accepted row with that hash
+    seen = Dict.empty(key_type=types.int64, value_type=types.int64)
+    seen[_hash_perm(perms_matrix[0])] = 0
+    # previous accepted row with the same hash, -1 ends the chain
+    next_same = np.full(k, -1, dtype=np.int64)
+
+    u = 0
+    while u < k - 1:
+        for i in range(n - 1, 0, -1):
+            j = np.random.randint(0, i + 1)
+            pInd[i], pInd[j] = pInd[j], pInd[i]
+        for i in range(n):
+            perm[i] = x[pInd[i]]
+
+        h = _hash_perm(perm)
+        head = seen[h] if h in seen else -1
+        row = head
+        while row != -1:
+            if _rows_equal(perms_matrix[row], perm):
+                break
+            row = next_same[row]
+        if row != -1:
+            continue  # duplicate of an accepted row
+
+        u += 1
+        next_same[u] = head
+        seen[h] = u
+        pInds[u, :] = pInd
+        perms_matrix[u, :] = perm
 
 
 def unique_permutations(X, k=None):
@@ -94,18 +170,19 @@ def unique_permutations(X, k=None):
     X = np.array(X).squeeze()
     assert len(X) > 1
 
-    if X.ndim == 1:
-        uniques, uind, c = np.unique(X, return_index=True, return_counts=True)
-    else:
-        # [u uind x] = unique(X, 'rows'); % x codes unique rows with integers
-        uniques, uind, c = np.unique(X, axis=0, return_index=True, return_counts=True)
-
-    uniques = uniques.tolist()
-    x = np.array([uniques.index(i) for i in X.tolist()])
-
-    c = sorted(c)
-    nPerms = np.prod(np.arange(c[-1] + 1, np.sum(c) + 1)) / np.prod([math.factorial(x) for x in c[:-1]])
-    nPerms = int(nPerms)
+    # [u uind x] = unique(X, 'rows'); % x codes unique rows with integers
+    axis = None if X.ndim == 1 else 0
+    uniques, uind, inverse, c = np.unique(X, axis=axis, return_index=True,
+                                          return_inverse=True, return_counts=True)
+    x = inverse.ravel().astype(np.int64)
+
+    # number of unique permutations is the multinomial coefficient of the
+    # counts, computed with exact integer arithmetic
+    nPerms = 1
+    remaining = int(np.sum(c))
+    for ci in c.tolist():
+        nPerms *= math.comb(remaining, ci)
+        remaining -= ci
     # % computation of permutation
     # Basics
     n = len(X);
@@ -119,14 +196,10 @@ def unique_permutations(X, k=None):
     Perms[0, :] = x;
 
     # Add permutations that are unique
-    u = 0;  # to start with
-    while u < k - 1:
-        pInd = np.random.permutation(int(n));
-        pInd = np.array(pInd).astype(int)  # just in case MATLAB permutation was monkey patched
-        if x[pInd].tolist() not in Perms.tolist():
-            u += 1
-            pInds[u, :] = pInd
-            Perms[u, :] = x[pInd]
+    # the seed is drawn from the global RNG, so np.random.seed still
+    # makes the results reproducible
+    seed = np.random.randint(0, 2**31 - 1)
+    _fill_unique_perms(x, int(k), n, pInds, Perms, seed)
     # %
     # Construct permutations of input
     if X.ndim == 1:
@@ -142,11 +215,13 @@ def unique_permutations(X, k=None):
 
 def char2num(seq):
     """convert list of chars to integers eg ABC=>012"""
-    if isinstance(seq, str):
-        seq = list(seq)
+    if not isinstance(seq, str):
+        seq = ''.join(seq)
     assert ord('A')-65 == 0
-    nums = [ord(c.upper())-65 for c in seq]
-    assert all([0<=n<=90 for n in nums])
+    seq = seq.upper()
+    assert seq.isascii(), f'only ASCII characters are supported, got {seq=}'
+    nums = np.frombuffer(seq.encode('ascii'), dtype=np.uint8).astype(int) - 65
+    assert ((0<=nums) & (nums<=90)).all()
     return nums
 
 
@@ -155,7 +230,10 @@ def num2char(arr):
     if isinstance(arr, int):
         return chr(arr+65)
     arr = np.array(arr, dtype=int)
-    return np.array([chr(x+65) for x in arr.ravel()]).reshape(*arr.shape)
+    # values are stored as single bytes, larger values would wrap around
+    assert ((0<=arr) & (arr+65<256)).all(), 'values must be between 0 and 190'
+    chars = np.frombuffer((arr+65).astype(np.uint8).tobytes(), dtype='S1')
+    return chars.astype(str).reshape(arr.shape)
 
 
 def tf2seq(TF):
@@ -167,6 +245,31 @@ def tf2seq(TF):
             np.where()
     return seq
 
+def _check_states(seq, n_states):
+    """the njit cores do not check bounds, so validate states beforehand"""
+    if len(seq) and (seq.min() < 0 or seq.max() >= n_states):
+        raise IndexError(f'sequence contains states outside of {n_states=}')
+
+
+@njit(cache=True)
+def _seq2tf_core(seq_arr, n_states):
+    """transition matrix of an integer sequence, see seq2tf"""
+    TF = np.zeros((n_states, n_states))
+    for i in range(len(seq_arr) - 1):
+        TF[seq_arr[i], seq_arr[i+1]] = 1.0
+    return TF
+
+
+@njit(cache=True)
+def _seq2tf2_core(seq_arr, n_states):
+    """2-step transition matrix of an integer sequence, see seq2TF_2step"""
+    TF2 = np.zeros((n_states**2, n_states), dtype=np.int64)
+    for i in range(len(seq_arr) - 2):
+        # row index codes the first two states of each triplet
+        TF2[seq_arr[i] * n_states + seq_arr[i+1], seq_arr[i+2]] = 1
+    return TF2
+
+
 def seq2tf(sequence, n_states=None):
     """
     create a transition matrix from a sequence string,
@@ -182,40 +285,38 @@ def seq2tf(sequence, n_states=None):
 
     """
 
-    seq = char2num(sequence)
+    seq = np.asarray(char2num(sequence), dtype=np.int64)
     if n_states is None:
         n_states = max(seq)+1
     # assert max(seq)+1==n_states, 'not all positions have a transition'
-    TF = np.zeros([n_states, n_states], dtype=int)
-    for i, p1 in enumerate(seq):
-        if i+1>=len(seq): continue
-        p2 = seq[(i+1) % len(seq)]
-        TF[p1, p2] = 1
-    return TF.astype(float)
-
-def seq2TF_2step(seq, n_states=None):
+    _check_states(seq, n_states)
+    return _seq2tf_core(seq, int(n_states))
+
+def seq2TF_2step(seq, n_states=None, as_dataframe=True):
     """create a transition matrix with all 2 steps from a sequence string,
-    e.g. ABCDEFGE. """
-    import pandas as pd
-    triplets = []
+    e.g. ABCDEFGE.
+
+    Only rows of state pairs that occur in the sequence are kept. If
+    as_dataframe=False, a tuple of the matrix and its row labels (e.g. 'AB')
+    is returned instead of a labeled pd.DataFrame."""
+    seq = np.asarray(char2num(seq), dtype=np.int64)
     if n_states is None:
-        n_states = max(char2num(seq))+1
-    TF2 = np.zeros([n_states**2, n_states], dtype=int)
-    for i, p1 in enumerate(seq):
-        if i+2>=len(seq): continue
-        triplet = seq[i] + seq[(i+1) % len(seq)] + seq[(i+2)% len(seq)]
-        i = char2num(triplet[0])[0] * n_states + char2num(triplet[1])[0]
-        j = char2num(triplet[2])
-        TF2[i, j] = 1
-        triplets.append(triplet)
+        n_states = max(seq)+1
+    _check_states(seq, n_states)
+    TF2 = _seq2tf2_core(seq, int(n_states))
 
+    nonzero_mask = TF2.any(axis=1)
     seq_set = num2char(np.arange(n_states))
+    index = [f'{y}{x}' for y in seq_set for x in seq_set]
+    index = [label for label, nonzero in zip(index, nonzero_mask) if nonzero]
+    TF2 = TF2[nonzero_mask]
+
+    if not as_dataframe:
+        return TF2, index
+
     # for visualiziation purposes
-    df = pd.DataFrame({c:TF2.T[i] for i,c in enumerate(seq_set)})
-    df['index'] = [f'{y}{x}' for y in seq_set for x in seq_set]
-    df = df.set_index('index')
-    TF2 = df.loc[~(df==0).all(axis=1)]
-    return TF2
+    df = pd.DataFrame(TF2, columns=seq_set, index=pd.Index(index, name='index'))
+    return df
 
 
 def simulate_eeg_resting_state(n_samples, alpha_freq=10.0, alpha_strength=1.0,
@@ -226,6 +327,106 @@ def simulate_eeg_localizer(n_samples, n_classes, noise=1.0, n_channels=64):
     raise NotImplementedError()
 
 
+@njit(cache=True)
+def _fenwick_build(weights):
+    """build a Fenwick tree (binary indexed tree) of weights in O(n).
+    The tree is 1-indexed, i.e. tree[0] is unused.
+
+    Node i holds the sum of weights in (i - lowbit(i), i], which is taken
+    as a difference of a single cumulative sum pass over the weights."""
+    n = len(weights)
+    cdf = np.zeros(n + 1)
+    cdf[1:] = np.cumsum(weights)
+    i = np.arange(1, n + 1)
+    tree = np.zeros(n + 1)
+    tree[1:] = cdf[i] - cdf[i - (i & -i)]
+    return tree
+
+
+@njit(cache=True)
+def _fenwick_add(tree, idx, delta):
+    """add delta to the weight at (0-based) idx"""
+    i = idx + 1
+    while i < len(tree):
+        tree[i] += delta
+        i += i & -i
+
+
+@njit(cache=True)
+def _fenwick_find(tree, r):
+    """find the first (0-based) index at which the cumulative weight exceeds r"""
+    pos = 0
+    step = 1
+    while step * 2 < len(tree):
+        step *= 2
+    while step > 0:
+        nxt = pos + step
+        if nxt < len(tree) and tree[nxt] <= r:
+            pos = nxt
+            r -= tree[nxt]
+        step //= 2
+    return pos
+
+
+@njit(cache=True)
+def _sample_onsets(p, rs, span):
+    """
+    draw non-overlapping onsets with probability proportional to p (in-place).
+
+    For each uniform random number in rs, an onset is drawn from the weights
+    in p by descending a Fenwick tree, afterwards the weights of all onsets
+    whose `span` samples would overlap with the drawn event are set to zero.
+    Both take O(log n) per index instead of a full pass over p for each event.
+    Returns fewer onsets than len(rs) if no more indices are available.
+    """
+    n = len(p)
+    tree = _fenwick_build(p)
+    total = p.sum()
+    n_available = np.count_nonzero(p)
+    onsets = np.empty(len(rs), dtype=np.int64)
+
+    for i in range(len(rs)):
+        if n_available < len(rs) - i:
+            return onsets[:i]
+        start_idx = min(_fenwick_find(tree, rs[i] * total), n - 1)
+        # accumulated rounding errors could let us land on a removed index,
+        # in that case take the closest available one
+        if p[start_idx] == 0:
+            j = start_idx
+            while j > 0 and p[j] == 0:
+                j -= 1
+            if p[j] == 0:
+                j = start_idx
+                while p[j] == 0:
+                    j += 1
+            start_idx = j
+
+        for j in range(max(0, start_idx - span + 1), min(start_idx + span, n)):
+            if p[j] != 0:
+                _fenwick_add(tree, j, -p[j])
+                total -= p[j]
+                p[j] = 0
+                n_available -= 1
+        onsets[i] = start_idx
+    return onsets
+
+
+@njit(cache=True)
+def _apply_events(data_sim, insert_data_T, sample_idxs, positions):
+    """add the samples insert_data_T[sample_idxs] onto data_sim (in-place),
+    each one centered at the corresponding position.
+    insert_data_T must be contiguous with shape (n_samples, times, sensors)"""
+    t, n_sensors = insert_data_T.shape[1:]
+    for i in range(len(positions)):
+        pattern = insert_data_T[sample_idxs[i]]
+        start = positions[i] - t//2
+        # plain loops over contiguous memory, auto-vectorized by LLVM
+        for ti in range(t):
+            for c in range(n_sensors):
+                data_sim[start+ti, c] += pattern[ti, c]
+    return data_sim
+
+
 def insert_events(data, insert_data, insert_labels, sequence, n_events,
                   lag=7, jitter=0, n_steps=2,  distribution='constant', return_onsets=False):
     """
@@ -293,7 +494,8 @@ def insert_events(data, insert_data, insert_labels, sequence, n_events,
 
     # get reproducible seed
     seed = int(''.join(([str(x) if x.isdigit() else str(ord(x)) for x in hash_array(data)])))
-    np.random.seed(seed)
+    # use a local generator, this leaves the global numpy RNG state untouched
+    rng = np.random.default_rng(seed)
 
     # Define default parameters for replay generation
     # defaults = {'dist':7,
@@ -320,81 +522,77 @@ def insert_events(data, insert_data, insert_labels, sequence, n_events,
     # Calculate length of the replay sequence
     padding = n_steps*lag + data.shape[-1]
     p[-padding:] = 0  # can't insert events starting here, would be too long
-    p = p/p.sum()
 
-    replay_start_idxs = []
-    all_idx = np.arange(len(data))
+    # events are centered on their position and jitter can shift later
+    # steps, so also exclude onsets for which any step could leave data
+    t = insert_data.shape[-1]
+    head = t//2 + max(0, n_steps*(jitter-lag))
+    tail = n_steps*(lag+jitter) + t - t//2
+    p[:head] = 0
+    p[max(0, len(p)-tail+1):] = 0
 
     # iteratively select starting index for replay event
-    # such that replay events are not overlapping
-    for i in range(n_events):
-        # next set all indices of p to zero where events will be inserted
-        # this way we can prevent overlap of replay event trains
-        # Find available indices where events can be inserted
-        available_indices = np.where(p > 0)[0]
-
-        # Ensure that there are enough available indices to choose from
-        if len(available_indices) < n_events - i:
-            raise ValueError(f"Not enough available indices to insert all events without overlap, {n_events=} too high")
-
-        # Choose a random index from the available indices
-        start_idx = np.random.choice(all_idx, p=p)
-
-        # this is the calculated end index
-        end_idx = start_idx + lag * n_steps + insert_data.shape[-1]
-        assert end_idx<len(p)
-        # Update the p array to zero out the region around the chosen index to prevent overlap
-        p[start_idx:end_idx] = 0
-
-        # normalize to create valid probability distribution
-        p = p/p.sum()
+    # such that replay events are not overlapping, see _sample_onsets.
+    # the window of an event including all jittered steps is [-head, tail)
+    span = head + tail
+    rs = rng.random(n_events)
+    replay_start_idxs = _sample_onsets(p, rs, span)
 
-        # Append the chosen index to the list of starting indices
-        replay_start_idxs.append(start_idx)
+    # Ensure that there were enough available indices to choose from
+    if len(replay_start_idxs) < n_events:
+        raise ValueError(f"Not enough available indices to insert all events without overlap, {n_events=} too high")
 
     data_sim = data.copy()  # work on copy of array to prevent mutable changes
 
+    # draw all random choices at once instead of once per inserted step
+    steps = np.arange(n_steps+1)
+    # choose the starting class such that the n_steps can actually be taken
+    # at that position to finish the sequence without looping to beginning
+    seq_is = rng.integers(0, len(sequence)-n_steps, size=n_events)
+    # choose which item should be inserted based on sequence order
+    class_idxs = np.asarray(list(sequence))[seq_is[:, None] + steps]
+
+    # jitter is added to the distance from the previous step, so the first
+    # step of each event is never jittered
+    jitters = np.zeros([n_events, n_steps+1], dtype=np.int64)
+    if jitter:
+        jitters[:, 1:] = rng.integers(-jitter, jitter+1, size=[n_events, n_steps])
+    # pos indicates where in data we insert each reactivation event
+    positions = replay_start_idxs[:, None] + steps * lag + jitters.cumsum(1)
+
+    # take a single random sample of each class (more noisy). The sample
+    # indices are grouped by class via a stable sort of insert_labels
+    order = np.argsort(insert_labels, kind='stable')
+    classes, counts = np.unique(insert_labels, return_counts=True)
+    class_pos = np.searchsorted(classes, class_idxs).clip(max=len(classes)-1)
+    assert (classes[class_pos] == class_idxs).all(), 'sequence contains classes not in insert_labels'
+    offsets = (np.cumsum(counts) - counts)[class_pos]
+    sample_idxs = order[offsets + rng.integers(counts[class_pos])].ravel()
+    logging.debug(f'{replay_start_idxs=}')
+
     # save data about inserted events here and return if requested
-    events = {'idx': [],
-              'pos': [],
-              'step': [],
-              'class_idx': [],
-              'span': [],
-              'jitter': []}
-
-    for idx,  start_idx in enumerate(replay_start_idxs):
-        smp_jitter = 0  # starting with no jitter
-        pos = start_idx  # pos indicates where in data we insert the next event
-
-        # choose the starting class such that the n_steps can actually be taken
-        # at that position to finish the sequence without looping to beginning
-        seq_i = np.random.choice(np.arange(len(sequence)-n_steps))
-        for step in range(n_steps+1):
-            # choose which item should be inserted based on sequence order
-            class_idx = sequence[seq_i]
-            # or take a single event (more noisy)
-            data_class = insert_data[insert_labels==class_idx]
-            idx_cls_i = np.random.choice(np.arange(len(data_class)))
-            insert_data_i = data_class[idx_cls_i]
-            assert insert_data_i.ndim==2
-
-            # time spans of the segments we want to insert
-            t = insert_data_i.shape[-1]
-
-            data_sim[pos-t//2:pos+1+t//2, :] += insert_data_i.T
-            logging.debug(f'{start_idx=} {pos=} {class_idx=}')
-
-            events['idx'] += [idx]
-            events['pos'] += [pos]
-            events['step'] += [step]
-            events['class_idx'] += [class_idx]
-            events['span'] += [insert_data_i.shape[-1]]
-            events['jitter'] += [smp_jitter]
-
-            # increment pos to select position of next reactivation event
-            smp_jitter = np.random.randint(-jitter, jitter+1) if jitter else 0
-            pos += lag + smp_jitter  # add next sequence step
-            seq_i += 1  # increment sequence id for next step
+    events = {'idx': np.repeat(np.arange(n_events), n_steps+1),
+              'pos': positions.ravel(),
+              'step': np.tile(steps, n_events),
+              'class_idx': class_idxs.ravel(),
+              'span': np.full(n_events * (n_steps+1), insert_data.shape[-1]),
+              'jitter': jitters.ravel()}
+
+    # _apply_events does not check bounds, so make sure that all events
+    # lie completely within data before inserting them
+    event_starts = events['pos'] - t//2
+    if (event_starts < 0).any() or (event_starts + t > len(data)).any():
+        raise ValueError('events would be inserted outside of data, '
+                         f'{len(data)=} is too short for {lag=}, {jitter=}, {n_steps=}')
+
+    # numba would silently truncate e.g. float patterns added to int data
+    if not np.can_cast(insert_data.dtype, data.dtype, 'same_kind'):
+        raise TypeError(f'cannot add insert_data of {insert_data.dtype=} to '
+                        f'{data.dtype=}, cast data to a matching type first')
+
+    # the actual insertion of the chosen samples is done in a compiled loop
+    insert_data_T = np.ascontiguousarray(insert_data.transpose(0, 2, 1))
+    _apply_events(data_sim, insert_data_T, sample_idxs, events['pos'])
 
     if return_onsets:
         df_onsets = pd.DataFrame(events)